@@ -1,6 +1,7 @@
+from typing import Optional
+
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 
 
 class Attention(nn.Module):
@@ -15,21 +16,23 @@ class Attention(nn.Module):
 
     def forward(self, output, context):
         context = self.dropout(context)
-        batch_size = output.size(0)
-        hidden_size = output.size(2)
-        input_size = context.size(1)
-        # (batch, out_len, dim) * (batch, in_len, dim) -> (batch, out_len, in_len)
-        attn = torch.bmm(output, context.transpose(1, 2))
-        if self.mask is not None:
-            attn.data.masked_fill_(self.mask, -float('inf'))
-        attn = F.softmax(attn.view(-1, input_size), dim=1).view(batch_size, -1, input_size)
-
-        # (batch, out_len, in_len) * (batch, in_len, dim) -> (batch, out_len, dim)
-        mix = torch.bmm(attn, context)
-
-        # concat -> (batch, out_len, 2*dim)
-        combined = torch.cat((mix, output), dim=2)
+        combined, attn = attend(output, context, self.mask)
         # output -> (batch, out_len, dim)
-        output = F.tanh(self.linear_out(combined.view(-1, 2 * hidden_size))).view(batch_size, -1, hidden_size)
+        output = torch.tanh(self.linear_out(combined))
 
         return output, attn
+
+
+@torch.jit.script
+def attend(output, context, mask: Optional[torch.Tensor]):
+    # (batch, out_len, dim) * (batch, in_len, dim) -> (batch, out_len, in_len)
+    attn = torch.bmm(output, context.transpose(1, 2))
+    if mask is not None:
+        attn = attn.masked_fill(mask, float('-inf'))
+    attn = torch.softmax(attn, dim=2)
+
+    # (batch, out_len, in_len) * (batch, in_len, dim) -> (batch, out_len, dim)
+    mix = torch.bmm(attn, context)
+
+    # concat -> (batch, out_len, 2*dim)
+    return torch.cat((mix, output), dim=2), attn
@@ -30,13 +30,10 @@ class Decoder(BaseCoder):
         # using cuda or not
         inputs = input_seq
         
-        # for bidrectional encoder
-        # encoder_hidden: (num_layers * num_directions, batch_size, hidden_size)
-        decoder_hidden = tuple([torch.cat([h[0:h.size(0):2], h[1:h.size(0):2]], 2) for h in encoder_hidden])
+        decoder_hidden = self.init_state(encoder_hidden)
 
         outputs = []
-        symbols = None      
-        
+
         prev = inputs[:, 0].unsqueeze(1)
         attention_hidden = None
 
@@ -52,14 +49,34 @@ class Decoder(BaseCoder):
                 prev = outputs[-1].topk(1)[1] # max probability index
             if stage != "train":
                 prev = outputs[-1].topk(1)[1]
-            
-            if symbols is None: 
-                symbols = prev
-            else:
-                symbols = torch.cat([symbols,prev],dim=1)
-        return outputs,decoder_hidden,symbols
 
+        # (batch_size, seq_length, vocab_size)
+        return torch.stack(outputs, dim=1),decoder_hidden
+
+
+
+    def init_state(self, encoder_hidden):
+        # for bidrectional encoder
+        # encoder_hidden: (num_layers * num_directions, batch_size, hidden_size)
+        # -> (num_layers, batch_size, num_directions * hidden_size)
+        return tuple([torch.cat([h[0:h.size(0):2], h[1:h.size(0):2]], 2) for h in encoder_hidden])
 
+    def forward_step(self, prev_tok, decoder_hidden, encoder_outputs, encoder_mask=None, k=1, banned_ids=None):
+        # one decoding step for a batch of previous tokens (batch_size,), reusing the
+        # encoder outputs computed once per source sentence
+        # encoder_mask: (batch_size, 1, src_len), True on padded source positions
+        # banned_ids: LongTensor of word ids that must never be predicted, e.g. `<pad>` and `<s>`
+        # only the k best words are returned: log-probs and ids of shape (batch_size, k),
+        # the (batch_size, vocab_size) distribution never leaves this step
+        self.attention.set_mask(encoder_mask)
+        softmax, decoder_hidden, _, _ = self.forward_helper(prev_tok.unsqueeze(1), decoder_hidden, encoder_outputs,
+                                                            None, F.log_softmax)
+        self.attention.set_mask(None)
+        softmax = softmax.squeeze(1)
+        if banned_ids is not None:
+            softmax = softmax.index_fill(1, banned_ids, -float('inf'))
+        top_log_probs, top_ids = softmax.topk(k, dim=1)
+        return top_log_probs, top_ids, decoder_hidden
 
     # could insert one parameter like: src_matrix
     def forward_helper(self, decoder_input, decoder_hidden, encoder_outputs,attention_prev, func):
@@ -71,5 +88,9 @@ class Decoder(BaseCoder):
             embeded = torch.mul(embedded, att)
         output,hidden = self.rnn(embedded, decoder_hidden)
         output, attention = self.attention(output, encoder_outputs) # Attention        
-        softmax = func(self.wsm(output.view(-1, self.hidden_size)), dim=1).view(batch_size,output_size,-1)
+        softmax = self.wsm(output.view(-1, self.hidden_size))
+        # func=None returns the raw logits
+        if func is not None:
+            softmax = func(softmax, dim=1)
+        softmax = softmax.view(batch_size,output_size,-1)
         return softmax, hidden, attention, output
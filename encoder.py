@@ -14,10 +14,11 @@ class Encoder(BaseCoder):
         for weight in self.rnn.parameters():
             nn.init.uniform_(weight,-0.1, 0.1)
 
-    def forward(self, input_seq, input_lengths=None):
+    def forward(self, input_seq, input_lengths):
         embedded = self.embedding(input_seq)
         #embedded = self.input_dropout(embedded)
-        embedded = nn.utils.rnn.pack_padded_sequence(embedded, input_lengths, batch_first=True)
+        # always packed, so padded steps never run through the LSTM; batches come sorted by length in descending order
+        embedded = nn.utils.rnn.pack_padded_sequence(embedded, input_lengths, batch_first=True, enforce_sorted=True)
         output, hidden = self.rnn(embedded)
         output, _ = nn.utils.rnn.pad_packed_sequence(output, batch_first=True)
         return output, hidden
@@ -5,12 +5,13 @@ A very basic implementation of neural machine translation
 
 Usage:
     nmt.py train --train-src=<file> --train-tgt=<file> --dev-src=<file> --dev-tgt=<file> --vocab=<file> [options]
-    nmt.py decode [options] MODEL_PATH TEST_SOURCE_FILE OUTPUT_FILE
-    nmt.py decode [options] MODEL_PATH TEST_SOURCE_FILE TEST_TARGET_FILE OUTPUT_FILE
+    nmt.py decode --vocab=<file> [options] MODEL_PATH TEST_SOURCE_FILE OUTPUT_FILE
+    nmt.py decode --vocab=<file> [options] MODEL_PATH TEST_SOURCE_FILE TEST_TARGET_FILE OUTPUT_FILE
 
 Options:
     -h --help                               show this screen.
     --cuda                                  use GPU
+    --compile                               compile the encoder and decoder with torch.compile, falling back to eager on compile errors
     --train-src=<file>                      train source file
     --train-tgt=<file>                      train target file
     --dev-src=<file>                        dev source file
@@ -27,6 +28,7 @@ Options:
     --max-num-trial=<int>                   terminate training after how many trials [default: 5]
     --lr-decay=<float>                      learning rate decay [default: 0.5]
     --beam-size=<int>                       beam size [default: 5]
+    --beam-sents=<int>                      number of sentences beam search decodes side by side [default: 16]
     --lr=<float>                            learning rate [default: 0.001]
     --uniform-init=<float>                  uniformly initialize all parameters [default: 0.1]
     --save-to=<file>                        model save path
@@ -39,27 +41,22 @@ import math
 import pickle
 import sys
 import time
-from collections import namedtuple
+from collections import namedtuple, deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from typing import List, Dict
 
 import numpy as np
-from typing import List, Tuple, Dict, Set, Union
-from docopt import docopt
-from tqdm import tqdm
-from nltk.translate.bleu_score import corpus_bleu, sentence_bleu, SmoothingFunction
-
-from utils import read_corpus, batch_iter
-from vocab import Vocab, VocabEntry
-
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
+from torch import optim
+from docopt import docopt
 
+from utils import read_corpus, batch_iter, bucket_iter
+# needed to unpickle vocabularies saved by running vocab.py as a script
+from vocab import Vocab, VocabEntry
 from encoder import Encoder
 from decoder import Decoder
-from torch import optim
-
-from loss import NLLLoss
-from optim import Optimizer
 
 
 Hypothesis = namedtuple('Hypothesis', ['value', 'score'])
@@ -67,30 +64,43 @@ Hypothesis = namedtuple('Hypothesis', ['value', 'score'])
 
 class NMT(object):
 
-    def __init__(self, embed_size, hidden_size, vocab, dropout_rate=0.2,keep_train=False):
+    def __init__(self, embed_size, hidden_size, vocab, dropout_rate=0.2,keep_train=False, use_compile=False):
         super(NMT, self).__init__()
 
         self.nvocab_src = len(vocab.src)
         self.nvocab_tgt = len(vocab.tgt)
         self.vocab = vocab
+        # plain list, so that mapping decoded ids back to words is a bare list index
+        self._id2word = [vocab.tgt.id2word[i] for i in range(self.nvocab_tgt)]
         self.encoder = Encoder(self.nvocab_src, hidden_size, embed_size, input_dropout=dropout_rate, n_layers=2)
         self.decoder = Decoder(self.nvocab_tgt, 2*hidden_size, embed_size,output_dropout=dropout_rate, n_layers=2,tf_rate=1.0)
         if keep_train:
             self.load('model')
-        LAS_params = list(self.encoder.parameters()) + list(self.decoder.parameters())
-        self.optimizer = optim.Adam(LAS_params, lr=0.0001)
+        self._all_params = list(self.encoder.parameters()) + list(self.decoder.parameters())
+        self.optimizer = optim.Adam(self._all_params, lr=0.0001)
         self.scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, step_size=1, gamma=0.5)
-        weight = torch.ones(self.nvocab_tgt)
-        self.loss = NLLLoss(weight=weight, mask=0, size_average=False)
-         # TODO: Perplexity or NLLLoss
-        # TODO: pass in mask to loss funciton
-        #self.loss = Perplexity(weight, 0)
-
-        if torch.cuda.is_available():
-            # Move the network and the optimizer to the GPU
-            self.encoder = self.encoder.cuda()
-            self.decoder = self.decoder.cuda()
-            self.loss.cuda()
+        # stateless, padding (id 0) is ignored; same 0.9 / 0.1 label smoothing as loss.NLLLoss
+        self.criterion = nn.CrossEntropyLoss(ignore_index=0, reduction='sum', label_smoothing=0.1)
+        # FP16 training on GPU: forward passes run under autocast, the loss is scaled for backward
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.use_amp = self.device.type == 'cuda'
+        self.scaler = torch.amp.GradScaler('cuda', enabled=self.use_amp)
+        # device memory the padded word ids of every batch are copied into
+        self._index_buf = DeviceBuffer(self.device)
+
+        # Move the network and the optimizer to the GPU, if there is one
+        self.encoder = self.encoder.to(self.device)
+        self.decoder = self.decoder.to(self.device)
+        self.criterion = self.criterion.to(self.device)
+
+        # in place, so that parameters and state dict keys stay those of the eager modules;
+        # 'reduce-overhead' replays CUDA graphs to save the kernel launches of every step
+        if use_compile and hasattr(nn.Module, 'compile'):
+            # compilation is lazy and only fails at the first forward, in the middle of training;
+            # let Dynamo run the failing frames eagerly instead of aborting
+            torch._dynamo.config.suppress_errors = True
+            self.encoder.compile(mode='reduce-overhead')
+            self.decoder.compile(mode='reduce-overhead')
 
 
     def __call__(self, src_sents, tgt_sents):
@@ -109,9 +119,10 @@ class NMT(object):
         """
         src_sents = self.vocab.src.words2indices(src_sents)
         tgt_sents = self.vocab.tgt.words2indices(tgt_sents)
-        src_sents, src_len, y_input, y_tgt, tgt_len  = sent_padding(src_sents, tgt_sents)
-        src_encodings, decoder_init_state = self.encode(src_sents,src_len)
-        scores, symbols = self.decode(src_encodings, decoder_init_state, [y_input, y_tgt], stage="train")
+        src_sents, src_len, y_input, y_tgt, tgt_len  = sent_padding(src_sents, tgt_sents, self._index_buf)
+        with torch.autocast('cuda', dtype=torch.float16, enabled=self.use_amp):
+            src_encodings, decoder_init_state = self.encode(src_sents,src_len)
+        scores = self.decode(src_encodings, decoder_init_state, [y_input, y_tgt], stage="train")
 
         return scores
 
@@ -148,20 +159,19 @@ class NMT(object):
                 each example in the input batch
         """
         tgt_input,tgt_target = tgt_sents
-        loss = self.loss
-        decoder_outputs, decoder_hidden,symbols = self.decoder(tgt_input, decoder_init_state, src_encodings) 
-        loss.reset()
-        for step, step_output in enumerate(decoder_outputs):
-            batch_size = tgt_input.size(0)
-            loss.eval_batch(step_output.contiguous().view(batch_size, -1), tgt_target[:, step])
+        with torch.autocast('cuda', dtype=torch.float16, enabled=self.use_amp):
+            decoder_outputs, decoder_hidden = self.decoder(tgt_input, decoder_init_state, src_encodings, func=None)
+            loss = self.compute_loss(decoder_outputs, tgt_target)
         self.optimizer.zero_grad()
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(self.encoder.parameters(), 5.0)
-        torch.nn.utils.clip_grad_norm_(self.decoder.parameters(), 5.0)
-        self.optimizer.step()
-        scores = loss.get_loss()
+        self.scaler.scale(loss).backward()
+        # clip the true gradients: unscale first, then one norm over encoder and decoder right before the update
+        self.scaler.unscale_(self.optimizer)
+        torch.nn.utils.clip_grad_norm_(self._all_params, 5.0)
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        scores = loss.item()
 
-        return scores, symbols
+        return scores
 
 
     def decode_without_bp(self, src_encodings, decoder_init_state, tgt_sents):
@@ -180,139 +190,237 @@ class NMT(object):
                 each example in the input batch
         """
         tgt_input,tgt_target = tgt_sents
-        loss = self.loss
-        decoder_outputs, decoder_hidden, symbols = self.decoder(tgt_input, decoder_init_state, src_encodings, stage="valid")
-        loss.reset()
-        for step, step_output in enumerate(decoder_outputs):
-            batch_size = tgt_input.size(0)
-            loss.eval_batch(step_output.contiguous().view(batch_size, -1), tgt_target[:, step])
+        decoder_outputs, decoder_hidden = self.decoder(tgt_input, decoder_init_state, src_encodings,
+                                                       func=None, stage="valid")
+        scores = self.compute_loss(decoder_outputs, tgt_target).item()
+
+        return scores
 
-        scores = loss.get_loss()
 
-        return scores, symbols
+    def compute_loss(self, decoder_outputs, tgt_target):
+        """
+        Summed cross entropy of the gold-standard target tokens, padding excluded
 
+        Args:
+            decoder_outputs: decoder logits of shape (batch_size, tgt_len, vocab_size)
+            tgt_target: gold-standard target token ids of shape (batch_size, tgt_len)
 
-    # TODO: sent_padding for only src
-    # def beam_search(self, src_sent: List[str], beam_size: int=5, max_decoding_time_step: int=70) -> List[Hypothesis]:
-    def beam_search(self, src_sent, beam_size, max_decoding_time_step):
+        Returns:
+            loss: a scalar tensor
         """
-        Given a single source sentence, perform beam search
+        # one fused log-softmax + nll over the whole batch
+        return self.criterion(decoder_outputs.reshape(-1, decoder_outputs.size(2)), tgt_target.reshape(-1))
+
+    # def beam_search(self, src_sents: List[List[str]], beam_size: int=5, max_decoding_time_step: int=70) -> List[List[Hypothesis]]:
+    def beam_search(self, src_sents, beam_size, max_decoding_time_step, n_concurrent_sents=16, progress=None):
+        """
+        Given a list of source sentences, perform batched beam search
+
+        The decoder always runs on a fixed batch of `n_concurrent_sents * beam_size` rows,
+        `beam_size` consecutive rows per sentence slot. As soon as a sentence finishes, its
+        slot is refilled with the next pending source sentence, so the batch stays full
+        instead of shrinking as sentences end. Each sentence is encoded exactly once, when
+        it enters a slot; its encodings stay in the slot rows for every decoding step.
 
         Args:
-            src_sent: a single tokenized source sentence
+            src_sents: a list of tokenized source sentences
             beam_size: beam size
             max_decoding_time_step: maximum number of time steps to unroll the decoding RNN
+            n_concurrent_sents: number of sentences decoded side by side; the decoder batch has
+                `n_concurrent_sents * beam_size` rows
+            progress: optional tqdm-like object, `update(1)` is called for every finished sentence
 
         Returns:
-            hypotheses: a list of hypothesis, each hypothesis has two fields:
+            hypotheses: for each source sentence, a list of hypothesis sorted by score, each
+                hypothesis has two fields:
                 value: List[str]: the decoded target sentence, represented as a list of words
                 score: float: the log-likelihood of the target sentence
         """
+        if len(src_sents) == 0:
+            return []
+
+        bos_id = self.vocab.tgt.word2id['<s>']
+        eos_id = self.vocab.tgt.word2id['</s>']
+        # never part of a decoded sentence
+        banned = [self.vocab.tgt.word2id['<pad>'], bos_id]
+        id2word = self._id2word
+        was_training = self.decoder.training
+        self.encoder.eval()
+        self.decoder.eval()
+
+        # longest first, like `batch_iter`, so every refill batch is already sorted for packing
+        pending = deque(sorted(range(len(src_sents)), key=lambda i: len(src_sents[i]), reverse=True))
+        n_slots = min(n_concurrent_sents, len(src_sents))
+        n_rows = n_slots * beam_size
+        max_src_len = len(src_sents[pending[0]])
+        n_layers, dim = self.decoder.n_layers, self.decoder.hidden_size
+
+        hypotheses = [None] * len(src_sents)
+        slot_sent = [None] * n_slots    # index of the sentence decoded in each slot
+        slot_start = [0] * n_slots      # time step at which that sentence entered its slot
+        slot_done = [[] for _ in range(n_slots)]    # (score, row, time step) of completed hypotheses
+        # the hypothesis pool is kept as arrays over rows: scores and last tokens on the device, and
+        # per time step the token chosen for every row and the row it was expanded from
+        back_tok = []
+        back_parent = []
+
+        def backtrack(row, start, end):
+            # words of the hypothesis in `row` after time step `end`, for a sentence admitted at `start`
+            tokens = []
+            for t in range(end - 1, start - 1, -1):
+                tokens.append(back_tok[t][row])
+                row = back_parent[t][row]
+            return [id2word[i] for i in reversed(tokens)]
+
+        device = self.device
+        with torch.inference_mode():
+            enc_buf = torch.zeros(n_rows, max_src_len, dim, device=device)
+            enc_mask = torch.ones(n_rows, 1, max_src_len, dtype=torch.bool, device=device)
+            h = torch.zeros(n_layers, n_rows, dim, device=device)
+            c = torch.zeros(n_layers, n_rows, dim, device=device)
+            last_tok = torch.full((n_rows,), bos_id, dtype=torch.long, device=device)
+            scores = torch.full((n_rows,), -float('inf'), device=device)
+            slot_offsets = torch.arange(0, n_rows, beam_size, device=device).unsqueeze(1)
+            banned_ids = torch.LongTensor(banned).to(device)
+
+            def refill(free_slots):
+                slots = free_slots[:len(pending)]
+                for s in free_slots[len(pending):]:
+                    slot_sent[s] = None
+                    scores[s * beam_size:(s + 1) * beam_size] = -float('inf')
+                if len(slots) == 0:
+                    return
+
+                sent_ids = [pending.popleft() for _ in slots]
+                src_ids, src_len = src_padding(self.vocab.src.words2indices([src_sents[i] for i in sent_ids]),
+                                               self._index_buf)
+                src_encodings, encoder_hidden = self.encode(src_ids, src_len)
+                init_h, init_c = self.decoder.init_state(encoder_hidden)
+
+                rows = torch.LongTensor([s * beam_size + j for s in slots for j in range(beam_size)])
+                rows = rows.to(device, non_blocking=True)
+                padded = src_encodings.new_zeros(len(slots), max_src_len, dim)
+                padded[:, :src_encodings.size(1)] = src_encodings
+                enc_buf[rows] = padded.repeat_interleave(beam_size, dim=0)
+                pad_mask = torch.arange(max_src_len).unsqueeze(0) >= torch.LongTensor(src_len).unsqueeze(1)
+                enc_mask[rows] = pad_mask.to(device, non_blocking=True).unsqueeze(1).repeat_interleave(beam_size, dim=0)
+                h[:, rows] = init_h.repeat_interleave(beam_size, dim=1)
+                c[:, rows] = init_c.repeat_interleave(beam_size, dim=1)
+                last_tok[rows] = bos_id
+                # only the first row of a fresh beam is live, the others would duplicate it
+                scores[rows] = -float('inf')
+                scores[rows[::beam_size]] = 0.
+
+                for s, sent_id in zip(slots, sent_ids):
+                    slot_sent[s] = sent_id
+                    slot_start[s] = len(back_tok)
+                    slot_done[s] = []
+
+            refill(list(range(n_slots)))
+
+            # the step always reads last_tok, h, c, enc_buf and enc_mask, which are only ever
+            # updated in place, so on GPU it can be captured once and replayed as a CUDA graph
+            def decoder_step():
+                # a row's best beam_size non-`</s>` words are always among its best beam_size + 1
+                return self.decoder.forward_step(last_tok, (h, c), enc_buf, enc_mask, k=beam_size + 1,
+                                                 banned_ids=banned_ids)
+            if device.type == 'cuda':
+                decoder_step = cuda_graph(decoder_step)
+
+            while any(sent_id is not None for sent_id in slot_sent):
+                word_log_probs, word_ids, (next_h, next_c) = decoder_step()
+                scores, parent, live_tok, host = \
+                    expand_beams(scores, word_log_probs, word_ids, slot_offsets, beam_size, eos_id)
+                last_tok.copy_(live_tok)
+                h.copy_(next_h[:, parent])
+                c.copy_(next_c[:, parent])
+
+                host = host.cpu().numpy()
+                eos_scores, live_scores = host[0].tolist(), host[1].tolist()
+                eos_parent, step_tok, step_parent = host[2:].astype(np.int64).tolist()
+                for s in range(n_slots):
+                    if slot_sent[s] is None:
+                        continue
+                    for r in range(s * beam_size, (s + 1) * beam_size):
+                        if eos_scores[r] > -float('inf'):
+                            slot_done[s].append((eos_scores[r], eos_parent[r], len(back_tok)))
+                back_tok.append(step_tok)
+                back_parent.append(step_parent)
+
+                free_slots = []
+                for s in range(n_slots):
+                    if slot_sent[s] is None:
+                        continue
+                    done = slot_done[s]
+                    best_done = max([score for score, _, _ in done], default=-float('inf'))
+                    # scores only decrease with length, so a beam whose best live hypothesis
+                    # already scores below the best completed one can be pruned
+                    if len(done) < beam_size and len(back_tok) - slot_start[s] < max_decoding_time_step \
+                            and live_scores[s * beam_size] > best_done:
+                        continue
+
+                    if not done:
+                        done = [(live_scores[r], r, len(back_tok)) for r in range(s * beam_size, (s + 1) * beam_size)]
+                    hypotheses[slot_sent[s]] = [Hypothesis(value=backtrack(row, slot_start[s], end), score=score)
+                                                for score, row, end in sorted(done, reverse=True)]
+                    free_slots.append(s)
+                    if progress is not None:
+                        progress.update(1)
+
+                if free_slots:
+                    refill(free_slots)
+
+        if was_training:
+            self.encoder.train()
+            self.decoder.train()
 
-        hypotheses = 0
         return hypotheses
-    
-    # def evaluate_ppl(self, dev_data: List[Any], batch_size: int=32):
-    def evaluate_ppl(self, dev_data, batch_size):
+
+    # def evaluate_ppl(self, dev_data: List[Any], batch_size: int=32, beam_size: int=5, max_decoding_time_step: int=70):
+    @torch.inference_mode()
+    def evaluate_ppl(self, dev_data, batch_size, beam_size=5, max_decoding_time_step=70, n_concurrent_sents=16):
         """
-        Evaluate perplexity on dev sentences
+        Evaluate perplexity on dev sentences, and the BLEU score of their beam search decoding
 
         Args:
             dev_data: a list of dev sentences
             batch_size: batch size
+            beam_size: beam size used to decode the dev sentences
+            max_decoding_time_step: maximum number of time steps to unroll the decoding RNN
+            n_concurrent_sents: number of sentences beam search decodes side by side
         
         Returns:
             ppl: the perplexity on dev sentences
         """
 
-        """
-        cum_loss = 0.
-        count = 0
-
-        ref_corpus = []
-        hyp_corpus = []
-        for src_sents, tgt_sents in batch_iter(dev_data, batch_size):
-            ref_corpus.extend(tgt_sents)
-            src_sents = self.vocab.src.words2indices(src_sents)
-            tgt_sents = self.vocab.tgt.words2indices(tgt_sents)
-            src_sents, src_len, y_input, y_tgt, tgt_len = sent_padding(src_sents, tgt_sents)
-            src_encodings, decoder_init_state = self.encode(src_sents, src_len)
-            decoder_outputs, loss = self.decode_without_bp(src_encodings, decoder_init_state, [y_input, y_tgt])
-            cum_loss += loss
-            count += 1
-
-            # decoder outputs to word sequence
-            hyp_np = np.zeros((len(tgt_sents), len(decoder_outputs), len(self.vocab.tgt)))
-
-            for step in range(len(decoder_outputs)):
-                tmp = decoder_outputs[step].cpu().data.numpy()
-                # print(tmp.shape)
-                hyp_np[:, step, :] = tmp
-            # print(hyp_np.shape)
-
-            # converting softmax to word string
-            for b in range(hyp_np.shape[0]):
-                word_seq = []
-                for step in range(hyp_np.shape[1]):
-                    pred_idx = np.argmax(hyp_np[b, step, :])
-                    # print(pred_idx)
-                    if pred_idx == self.vocab.tgt.word2id['</s>']:
-                        break
-                    word_seq.append(self.vocab.tgt.id2word[pred_idx])
-                hyp_corpus.append(word_seq)
-
-            # tgt_word_num_to_predict = sum(len(s[1:]) for s in tgt_sents)  # omitting the leading `<s>`
-            # cum_tgt_words += tgt_word_num_to_predict
-
-        # ppl = np.exp(cum_loss / cum_tgt_words)
-        for r, h in zip(ref_corpus, hyp_corpus):
-            print(r)
-            print(h)
-            print()
-        bleu = compute_corpus_level_bleu_score(ref_corpus, hyp_corpus)
-        print('bleu score: ', bleu)
-
-        return cum_loss / count
-        """
-
-        ref_corpus = []
-        hyp_corpus = []
         cum_loss = 0
         count = 0
-        hyp_corpus_ordered = []
-        with torch.no_grad():
+        # one beam search over the whole dev set, so that its slots stay full until the very end
+        hyp_corpus = [hyps[0].value for hyps in
+                      self.beam_search([src for src, _ in dev_data], beam_size, max_decoding_time_step,
+                                       n_concurrent_sents)]
+        # n-gram counting runs in a worker thread while the loss of the next batch is computed
+        with ThreadPoolExecutor(max_workers=1) as bleu_executor:
+            bleu_stats = []
+            batch_start = 0
             for src_sents, tgt_sents, orig_indices in batch_iter(dev_data, batch_size):
-                ref_corpus.extend(tgt_sents)
-                actual_size = len(src_sents)
+                # batches are consecutive slices of dev_data, sorted by source length within the slice
+                batch_hyps = [hyp_corpus[batch_start + i] for i in orig_indices]
+                batch_start += len(orig_indices)
+                bleu_stats.append(bleu_executor.submit(corpus_bleu_stats, tgt_sents, batch_hyps))
+
                 src_sents = self.vocab.src.words2indices(src_sents)
                 tgt_sents = self.vocab.tgt.words2indices(tgt_sents)
-                src_sents, src_len, y_input, y_tgt, tgt_len = sent_padding(src_sents, tgt_sents)
+                src_sents, src_len, y_input, y_tgt, tgt_len = sent_padding(src_sents, tgt_sents, self._index_buf)
                 src_encodings, decoder_init_state = self.encode(src_sents,src_len)
-                scores, symbols = self.decode_without_bp(src_encodings, decoder_init_state, [y_input, y_tgt])
-                #sents = np.zeros((len(symbols),actual_size))
-                #for i,symbol in enumerate(symbols):
-                #    sents[i,:] = symbol.data.cpu().numpy()
-                    # print(sents.T)
-
-                index = 0
-                batch_hyp_orderd = [None] * symbols.size(0)
-                for sent in symbols:
-
-                    word_seq = []
-                    for idx in sent:
-                        if idx == 2:
-                            break
-                        word_seq.append(self.vocab.tgt.id2word[np.asscalar(idx)])
-                    hyp_corpus.append(word_seq)
-                    batch_hyp_orderd[orig_indices[index]] = word_seq
-                    index += 1
-                hyp_corpus_ordered.extend(batch_hyp_orderd)
+                scores = self.decode_without_bp(src_encodings, decoder_init_state, [y_input, y_tgt])
+
                 cum_loss += scores
                 count += 1
+            bleu = bleu_from_stats(np.sum([stats.result() for stats in bleu_stats], axis=0))
         with open('decode.txt', 'a') as f:
-            for r, h in zip(ref_corpus, hyp_corpus_ordered):
+            for h in hyp_corpus:
                 f.write(" ".join(h) + '\n')
-        bleu = compute_corpus_level_bleu_score(ref_corpus, hyp_corpus)
         print('bleu score: ', bleu)
         
         return cum_loss / count
@@ -333,44 +441,134 @@ class NMT(object):
         torch.save(self.decoder.state_dict(), model_save_path + '-decoder')
 
 
-def to_cuda(tensor):
-    # Tensor -> Variable (on GPU if possible)
-    if torch.cuda.is_available():
-    # Tensor -> GPU Tensor
-        tensor = tensor.cuda()
-    return tensor
-
+def cuda_graph(step, n_warmup=3):
+    """
+    Capture the CUDA kernels of `step()` into a graph. The returned function replays them and
+    returns the output tensors of the capture, which every replay overwrites; `step` has to read
+    its inputs from tensors that keep their storage, and the caller copies new inputs into them
+    """
+    # warm up on a side stream, as required before capturing
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        for _ in range(n_warmup):
+            step()
+    torch.cuda.current_stream().wait_stream(stream)
+
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        outputs = step()
+
+    def replay():
+        graph.replay()
+        return outputs
+
+    return replay
+
+
+@torch.jit.script
+def expand_beams(scores, word_log_probs, word_ids, slot_offsets, beam_size: int, eos_id: int):
+    # scores: (n_rows,), word_log_probs / word_ids: (n_rows, k) best words of every row,
+    # slot_offsets: (n_slots, 1) first row of each slot
+    k = word_log_probs.size(1)
+    n_slots = slot_offsets.size(0)
+
+    # expand every row, then keep the best 2 * beam_size candidates per sentence;
+    # at most beam_size of them end with `</s>`, so beam_size live ones always remain
+    cand_scores = (scores.unsqueeze(1) + word_log_probs).view(n_slots, beam_size * k)
+    top_scores, top_idx = cand_scores.topk(2 * beam_size, dim=1)
+    top_tok = word_ids.view(n_slots, beam_size * k).gather(1, top_idx)
+    top_parent = torch.div(top_idx, k, rounding_mode='floor') + slot_offsets
+    is_eos = top_tok == eos_id
+
+    live_scores, live_rank = top_scores.masked_fill(is_eos, float('-inf')).topk(beam_size, dim=1)
+    parent = top_parent.gather(1, live_rank).view(-1)
+    live_tok = top_tok.gather(1, live_rank).view(-1)
+
+    # `</s>` candidates ranked within the top beam_size of their sentence complete a hypothesis;
+    # everything the host needs is packed into one (5, n_rows) tensor, so that a step costs a
+    # single device -> host copy. float64 holds the word and row ids exactly
+    eos_scores = top_scores[:, :beam_size].masked_fill(~is_eos[:, :beam_size], float('-inf'))
+    host = torch.stack([eos_scores.reshape(-1), live_scores.reshape(-1),
+                        top_parent[:, :beam_size].reshape(-1).double(), live_tok.double(), parent.double()])
+    return live_scores.view(-1), parent, live_tok, host
+
+
+def ragged_index(lens):
+    # (row, column) of every token of a batch of sentences with lengths `lens`
+    rows = np.repeat(np.arange(len(lens)), lens)
+    cols = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+    return rows, cols
+
+
+class DeviceBuffer(object):
+    """
+    A flat LongTensor on the GPU that is reused by every batch instead of allocating new
+    tensors per step; it only grows when a batch needs more room than any batch before
+    """
 
-def sent_padding(src_sents, tgt_sents):
+    def __init__(self, device):
+        self.device = device
+        self.buf = None
+
+    def load(self, array):
+        # copy a flat int64 numpy array into the front of the buffer, returns that slice
+        tensor = torch.from_numpy(array)
+        if self.device.type != 'cuda':
+            return tensor
+        if self.buf is None or self.buf.numel() < tensor.numel():
+            # never an inference tensor, even when it grows during evaluation, so training can reuse it
+            with torch.inference_mode(False):
+                self.buf = torch.empty(tensor.numel(), dtype=torch.long, device=self.device)
+        view = self.buf[:tensor.numel()]
+        view.copy_(tensor.pin_memory(), non_blocking=True)
+        return view
+
+
+def pad_src_block(src_sents, n_extra=0):
+    # flat int64 array holding the padded (batch_size, max_src_len) source ids, followed by
+    # `n_extra` zeros the caller can fill with more data that has to be copied with them
     batch_size = len(src_sents)
+    src_lens = np.fromiter((len(sent) for sent in src_sents), dtype=np.int64, count=batch_size)
+    src_size = batch_size * src_lens.max()
+
+    padded = np.zeros(src_size + n_extra, dtype=np.int64)
+    padded[:src_size].reshape(batch_size, -1)[ragged_index(src_lens)] = \
+        np.fromiter(chain.from_iterable(src_sents), dtype=np.int64, count=src_lens.sum())
+    return padded, src_lens
 
-    max_src_len = max([len(sent) for sent in src_sents])
-    max_tgt_len = max([len(sent) for sent in tgt_sents])
 
-    padded_src_sents = np.zeros((batch_size, max_src_len))
-    padded_Yinput = np.zeros((batch_size, max_tgt_len))
-    padded_Ytarget = np.zeros((batch_size, max_tgt_len))
+def src_padding(src_sents, buf):
+    padded, src_lens = pad_src_block(src_sents)
 
-    src_lens = []
-    tgt_lens = []
+    return buf.load(padded).view(len(src_sents), -1), src_lens.tolist()
 
-    for i, sent in enumerate(zip(src_sents, tgt_sents)):
-        src_sent = sent[0]
-        y_input = sent[1][:-1]
-        y_target = sent[1][1:]
 
-        src_len = len(src_sent)
-        tgt_len = len(y_input)
+def sent_padding(src_sents, tgt_sents, buf):
+    batch_size = len(src_sents)
+
+    # y_input drops the trailing `</s>`, y_target the leading `<s>`
+    tgt_lens = np.fromiter((len(sent) for sent in tgt_sents), dtype=np.int64, count=batch_size) - 1
+    max_tgt_len = tgt_lens.max()
 
-        padded_src_sents[i, :src_len] = src_sent
-        padded_Yinput[i, :tgt_len] = y_input
-        padded_Ytarget[i, :tgt_len] = y_target
+    # source, y_input and y_target share one flat buffer, so a single copy moves all of them
+    tgt_size = batch_size * max_tgt_len
+    padded, src_lens = pad_src_block(src_sents, n_extra=2 * tgt_size)
+    src_size = padded.size - 2 * tgt_size
+    padded_Yinput = padded[src_size:src_size + tgt_size].reshape(batch_size, max_tgt_len)
+    padded_Ytarget = padded[src_size + tgt_size:].reshape(batch_size, max_tgt_len)
 
-        src_lens.append(src_len)
-        tgt_lens.append(tgt_len)
+    tgt_words = np.fromiter(chain.from_iterable(tgt_sents), dtype=np.int64, count=(tgt_lens + 1).sum())
+    rows, cols = ragged_index(tgt_lens + 1)
+    is_input = cols < tgt_lens[rows]
+    is_target = cols > 0
+    padded_Yinput[rows[is_input], cols[is_input]] = tgt_words[is_input]
+    padded_Ytarget[rows[is_target], cols[is_target] - 1] = tgt_words[is_target]
 
-    return to_cuda(torch.LongTensor(padded_src_sents)), src_lens, \
-           to_cuda(torch.LongTensor(padded_Yinput)), to_cuda(torch.LongTensor(padded_Ytarget)), tgt_lens
+    padded = buf.load(padded)
+    return padded[:src_size].view(batch_size, -1), src_lens.tolist(), \
+           padded[src_size:src_size + tgt_size].view(batch_size, max_tgt_len), \
+           padded[src_size + tgt_size:].view(batch_size, max_tgt_len), tgt_lens.tolist()
 
 
 # def compute_corpus_level_bleu_score(references: List[List[str]], hypotheses: List[Hypothesis]) -> float:
@@ -385,6 +583,9 @@ def compute_corpus_level_bleu_score(references, hypotheses):
     Returns:
         bleu_score: corpus-level BLEU score
     """
+    # nltk is slow to import and only needed here
+    from nltk.translate.bleu_score import corpus_bleu
+
     if references[0][0] == '<s>':
         references = [ref[1:-1] for ref in references]
 
@@ -396,6 +597,55 @@ def compute_corpus_level_bleu_score(references, hypotheses):
     return bleu_score
 
 
+# def corpus_bleu_stats(references: List[List[str]], hypotheses: List[List[str]], max_order: int=4) -> np.ndarray:
+def corpus_bleu_stats(references, hypotheses, max_order=4):
+    """
+    Count the sufficient statistics of corpus-level BLEU, so that they can be summed over batches
+
+    Args:
+        references: a list of gold-standard reference target sentences
+        hypotheses: a list of hypotheses, one for each reference, as lists of words
+        max_order: maximum n-gram order
+
+    Returns:
+        stats: array of clipped n-gram matches for orders 1..max_order, followed by the number of
+            hypothesis n-grams for orders 1..max_order, the hypothesis length and the reference length
+    """
+    stats = np.zeros(2 * max_order + 2, dtype=np.int64)
+    for ref, hyp in zip(references, hypotheses):
+        if len(ref) > 0 and ref[0] == '<s>':
+            ref = ref[1:-1]
+        for n in range(1, max_order + 1):
+            ref_ngrams = Counter(tuple(ref[i:i + n]) for i in range(len(ref) - n + 1))
+            hyp_ngrams = Counter(tuple(hyp[i:i + n]) for i in range(len(hyp) - n + 1))
+            stats[n - 1] += sum((hyp_ngrams & ref_ngrams).values())
+            # like nltk, every sentence counts at least one n-gram per order
+            stats[max_order + n - 1] += max(len(hyp) - n + 1, 1)
+        stats[-2] += len(hyp)
+        stats[-1] += len(ref)
+
+    return stats
+
+
+# def bleu_from_stats(stats: np.ndarray) -> float:
+def bleu_from_stats(stats):
+    """
+    Corpus-level BLEU from the statistics of `corpus_bleu_stats`, matching nltk's unsmoothed `corpus_bleu`
+    """
+    max_order = (len(stats) - 2) // 2
+    matches, totals = stats[:max_order], stats[max_order:2 * max_order]
+    hyp_len, ref_len = stats[-2], stats[-1]
+    if matches[0] == 0:
+        return 0.
+
+    # like nltk, orders without any match contribute the smallest positive float
+    log_precision = sum(math.log(m / t) if m > 0 else math.log(sys.float_info.min)
+                        for m, t in zip(matches, totals)) / max_order
+    brevity_penalty = 1. if hyp_len > ref_len else math.exp(1 - ref_len / hyp_len)
+
+    return brevity_penalty * math.exp(log_precision)
+
+
 # def train(args: Dict[str, str]):
 def train(args):
     train_data_src = read_corpus(args['--train-src'], source='src')
@@ -420,7 +670,8 @@ def train(args):
     model = NMT(embed_size=int(args['--embed-size']),
                 hidden_size=int(args['--hidden-size']),
                 dropout_rate=float(args['--dropout']),
-                vocab=vocab,keep_train=True)
+                vocab=vocab,keep_train=True,
+                use_compile=args['--compile'])
 
     num_trial = 0
     train_iter = patience = cum_loss = report_loss = cumulative_tgt_words = report_tgt_words = 0
@@ -434,7 +685,7 @@ def train(args):
     while True:
         epoch += 1
 
-        for src_sents, tgt_sents, _ in batch_iter(train_data, batch_size=train_batch_size, shuffle=True):
+        for src_sents, tgt_sents, _ in bucket_iter(train_data, batch_size=train_batch_size, shuffle=True):
             train_iter += 1
 
             batch_size = len(src_sents)
@@ -482,7 +733,10 @@ def train(args):
                 print('begin validation ...', file=sys.stderr)
 
                 # compute dev. ppl and bleu
-                dev_ppl = model.evaluate_ppl(dev_data, batch_size=128)   # dev batch size can be a bit larger
+                dev_ppl = model.evaluate_ppl(dev_data, batch_size=128,   # dev batch size can be a bit larger
+                                             beam_size=int(args['--beam-size']),
+                                             max_decoding_time_step=int(args['--max-decoding-time-step']),
+                                             n_concurrent_sents=int(args['--beam-sents']))
                 valid_metric = -dev_ppl
 
                 print('validation: iter %d, dev. ppl %f' % (train_iter, dev_ppl), file=sys.stderr)
@@ -526,14 +780,14 @@ def train(args):
 
 
 
-def beam_search(model: NMT, test_data_src: List[List[str]], beam_size: int, max_decoding_time_step: int) -> List[List[Hypothesis]]:
-    was_training = model.training
+def beam_search(model: NMT, test_data_src: List[List[str]], beam_size: int, max_decoding_time_step: int,
+                n_concurrent_sents: int=16) -> List[List[Hypothesis]]:
+    from tqdm import tqdm
 
-    hypotheses = []
-    for src_sent in tqdm(test_data_src, desc='Decoding', file=sys.stdout):
-        example_hyps = model.beam_search(src_sent, beam_size=beam_size, max_decoding_time_step=max_decoding_time_step)
-
-        hypotheses.append(example_hyps)
+    with tqdm(total=len(test_data_src), desc='Decoding', file=sys.stdout) as progress:
+        hypotheses = model.beam_search(test_data_src, beam_size=beam_size,
+                                       max_decoding_time_step=max_decoding_time_step,
+                                       n_concurrent_sents=n_concurrent_sents, progress=progress)
 
     return hypotheses
 
@@ -549,14 +803,21 @@ def decode(args: Dict[str, str]):
         test_data_tgt = read_corpus(args['TEST_TARGET_FILE'], source='tgt')
 
     print(f"load model from {args['MODEL_PATH']}", file=sys.stderr)
-    model = NMT.load(args['MODEL_PATH'])
+    vocab = pickle.load(open(args['--vocab'], 'rb'))
+    model = NMT(embed_size=int(args['--embed-size']),
+                hidden_size=int(args['--hidden-size']),
+                dropout_rate=float(args['--dropout']),
+                vocab=vocab,
+                use_compile=args['--compile'])
+    model.load(args['MODEL_PATH'])
 
     hypotheses = beam_search(model, test_data_src,
                              beam_size=int(args['--beam-size']),
-                             max_decoding_time_step=int(args['--max-decoding-time-step']))
+                             max_decoding_time_step=int(args['--max-decoding-time-step']),
+                             n_concurrent_sents=int(args['--beam-sents']))
 
     if args['TEST_TARGET_FILE']:
-        top_hypotheses = [hyps[0] for hyps in hypotheses]
+        top_hypotheses = [hyps[0].value for hyps in hypotheses]
         bleu_score = compute_corpus_level_bleu_score(test_data_tgt, top_hypotheses)
         print(f'Corpus BLEU: {bleu_score}', file=sys.stderr)
 
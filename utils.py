@@ -44,13 +44,50 @@ def batch_iter(data, batch_size, shuffle=False):
 
     for i in range(batch_num):
         indices = index_array[i * batch_size: (i + 1) * batch_size]
-        examples = [(data[idx], idx - i * batch_size) for idx in indices]
+        yield make_batch(data, indices)
 
-        examples = sorted(examples, key=lambda e: len(e[0][0]), reverse=True)
-        orig_indices = [e[1] for e in examples]
-        examples = [e[0] for e in examples]
-        src_sents = [e[0] for e in examples]
-        tgt_sents = [e[1] for e in examples]
 
+def bucket_iter(data, batch_size, batches_per_bucket=100, shuffle=False):
+    """
+    Given a list of examples, slice them into mini-batches of similar source length.
+    Examples are sorted by source length and cut into buckets of `batches_per_bucket` batches;
+    with `shuffle`, ties are broken randomly and both the bucket order and the batch order
+    within each bucket are shuffled, but examples never leave their bucket
+    """
+    index_array = np.arange(len(data))
+    if shuffle:
+        np.random.shuffle(index_array)
+    # stable sort, so that the shuffle above breaks ties between equal lengths
+    src_lens = np.array([len(data[idx][0]) for idx in index_array])
+    index_array = index_array[np.argsort(src_lens, kind='stable')].tolist()
+
+    bucket_size = batch_size * batches_per_bucket
+    buckets = []
+    for i in range(0, len(index_array), bucket_size):
+        bucket = index_array[i: i + bucket_size]
+        buckets.append([bucket[j: j + batch_size] for j in range(0, len(bucket), batch_size)])
+
+    if shuffle:
+        np.random.shuffle(buckets)
+        for bucket in buckets:
+            np.random.shuffle(bucket)
+
+    for bucket in buckets:
+        for indices in bucket:
+            yield make_batch(data, indices)
+
+
+def make_batch(data, indices):
+    """
+    Gather the examples at `indices`, sorted by source length in descending order; `orig_indices`
+    gives the position of every sorted example in `indices`
+    """
+    examples = [(data[idx], i) for i, idx in enumerate(indices)]
+
+    examples = sorted(examples, key=lambda e: len(e[0][0]), reverse=True)
+    orig_indices = [e[1] for e in examples]
+    examples = [e[0] for e in examples]
+    src_sents = [e[0] for e in examples]
+    tgt_sents = [e[1] for e in examples]
 
-        yield src_sents, tgt_sents, orig_indices
+    return src_sents, tgt_sents, orig_indices
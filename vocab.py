@@ -61,10 +61,12 @@ class VocabEntry(object):
             return self[word]
 
     def words2indices(self, sents):
+        # same lookup as `__getitem__`, without a method call per word
+        get, unk_id = self.word2id.get, self.unk_id
         if type(sents[0]) == list:
-            return [[self[w] for w in s] for s in sents]
+            return [[get(w, unk_id) for w in s] for s in sents]
         else:
-            return [self[w] for w in sents]
+            return [get(w, unk_id) for w in sents]
 
     @staticmethod
     def from_corpus(corpus, size, freq_cutoff=2):